@@ -1,27 +1,241 @@
 import os
+import html
+import time
+import queue
+import atexit
+import asyncio
 import logging
+import contextvars
+import logging.handlers
 import urllib.parse
-from telegram import Update
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from functools import lru_cache
+
+# Use uvloop's libuv-based event loop when it is installed (Linux/macOS only)
+try:
+    import uvloop
+except ImportError:
+    pass
+else:
+    asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import JSONResponse
+from telegram import LinkPreviewOptions, Message, TelegramObject, Update
+from telegram.constants import ChatType, ParseMode
+from telegram.error import BadRequest, RetryAfter, TimedOut
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
+from telegram.request import HTTPXRequest
 
 # --- Configuration ---
 # Enable logging
-logging.basicConfig(
-    format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO
+# Records are handed to a QueueListener thread that does the actual stderr writes,
+# so logging never blocks the event loop.
+_log_queue = queue.SimpleQueue()
+_log_stream_handler = logging.StreamHandler()
+_log_stream_handler.setFormatter(
+    logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
 )
+_log_listener = logging.handlers.QueueListener(_log_queue, _log_stream_handler)
+_log_listener.start()
+atexit.register(_log_listener.stop)
+logging.getLogger().addHandler(logging.handlers.QueueHandler(_log_queue))
+logging.getLogger().setLevel(logging.INFO)
 logger = logging.getLogger(__name__)
 
 # --- Environment Variables ---
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 # The base URL of your deployed Vercel instance (e.g., https://your-vercel-app.vercel.app)
 VERCEL_BASE_URL = os.environ.get("VERCEL_BASE_URL")
+# The public URL of this bot's web service (e.g., https://your-bot.onrender.com), used to register the webhook
+WEBHOOK_BASE_URL = os.environ.get("WEBHOOK_BASE_URL", "").rstrip("/")
+# Set VERCEL_RESOLVES_FILE_ID=1 if the Vercel app accepts ?file_id= and calls get_file itself.
+# The bot then skips its own get_file round-trip and links with the file_id directly.
+VERCEL_RESOLVES_FILE_ID = os.environ.get("VERCEL_RESOLVES_FILE_ID", "").lower() in ("1", "true", "yes")
+
+# Bot API server endpoints. Point these at a self-hosted telegram-bot-api server (or a CDN in front of it)
+# to cut get_file latency and lift the 20 MB download limit; the generated file links use it too.
+# The server must run without --local: in local mode get_file returns paths on the server's disk,
+# which the Vercel app has no way to download.
+TG_API_BASE = os.environ.get("TG_API_BASE", "https://api.telegram.org/bot")
+TG_FILE_BASE = os.environ.get("TG_FILE_BASE", "https://api.telegram.org/file/bot")
+
+# The direct Telegram file URL prefix never changes, so it is built and URL-encoded once here.
+# Only the per-file file_path has to be encoded in the handler.
+# Format: <TG_FILE_BASE><token>/<file_path>, e.g. https://api.telegram.org/file/bot<token>/<file_path>
+# Built the same way PTB builds Bot.base_file_url, which also accepts a {token} placeholder.
+if "{token}" in TG_FILE_BASE:
+    TG_FILE_PREFIX = TG_FILE_BASE.format(token=BOT_TOKEN) + "/"
+else:
+    TG_FILE_PREFIX = f"{TG_FILE_BASE}{BOT_TOKEN}/"
+TG_FILE_PREFIX_ENC = urllib.parse.quote_plus(TG_FILE_PREFIX)
+
+def _relative_file_path(file_path: str) -> str:
+    """Strips TG_FILE_PREFIX from a file_path returned by get_file.
+
+    PTB's get_file already returns the full download URL (<TG_FILE_PREFIX><path>), so the prefix has to
+    come off before the pre-encoded TG_FILE_PREFIX_ENC can be put back in front of it.
+
+    Raises ValueError for the absolute paths a --local Bot API server returns. PTB passes those
+    through unchanged when the file exists on this machine, and prefixes them otherwise.
+    """
+    relative_path = file_path.removeprefix(TG_FILE_PREFIX)
+    if relative_path == file_path or relative_path.startswith("/"):
+        raise ValueError(
+            "The Bot API server returned a local file path, which can't be downloaded over HTTP. "
+            "Run telegram-bot-api without --local."
+        )
+    return relative_path
+
+# --- URL Encoding ---
+# Table-driven equivalents of urllib.parse.quote (_QUOTE_TABLE) and quote_plus (_QUOTE_PLUS_TABLE):
+# every byte maps straight to itself or to its %XX escape, instead of going through urllib's Quoter.
+_SAFE_BYTES = frozenset(b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789_.-~")
+_QUOTE_TABLE = [bytes([c]) if c in _SAFE_BYTES or c == ord("/") else f"%{c:02X}".encode() for c in range(256)]
+_QUOTE_PLUS_TABLE = [bytes([c]) if c in _SAFE_BYTES else f"%{c:02X}".encode() for c in range(256)]
+_QUOTE_PLUS_TABLE[ord(" ")] = b"+"
+
+def _quote_into(buf: bytearray, s: str, table: list[bytes]) -> None:
+    """Appends the percent-encoded UTF-8 bytes of s to buf, using table for the escapes."""
+    buf += b"".join(map(table.__getitem__, s.encode()))
+
+# Query string prefixes for build_urls: either the pre-encoded Telegram file URL prefix,
+# followed by the file_path, or just the file_id when the Vercel app resolves it.
+_FILE_URL_QUERY = b"?file_url=" + TG_FILE_PREFIX_ENC.encode("ascii")
+_FILE_ID_QUERY = b"?file_id="
+
+# Memoized: the same file names and paths come up again whenever a file is reforwarded.
+@lru_cache(maxsize=1024)
+def build_urls(base: str, filename: str, query_prefix: bytes, value: str) -> tuple[str, str]:
+    """Returns the Vercel (streaming, download) links for filename.
+
+    The quoted filename, query_prefix and quote_plus-encoded value are written into one buffer,
+    and the resulting suffix is shared by both links.
+    """
+    buf = bytearray()
+    _quote_into(buf, filename, _QUOTE_TABLE)
+    buf += query_prefix
+    _quote_into(buf, value, _QUOTE_PLUS_TABLE)
+    suffix = buf.decode("ascii")
+    return f"{base}/watch/{suffix}", f"{base}/download/{suffix}"
+
+# Static fragments of the reply, joined around the per-file fields in one pass.
+# Uses HTML parse mode; the file name must be html.escape'd before joining.
+_RESP_FILE = "<b>File:</b> <code>"
+_RESP_STREAM = "</code>\n\n<b>Streaming Link:</b>\n<code>"
+_RESP_DOWNLOAD = "</code>\n\n<b>Download Link:</b>\n<code>"
+_RESP_TAIL = "</code>\n\nThe Vercel application will stream the file directly from Telegram's servers."
+_NO_LINK_PREVIEW = LinkPreviewOptions(is_disabled=True)
+
+# Canned replies for the errors expected from get_file, so repeated failures don't format a new
+# message every time. Other exceptions fall back to a reply that includes the error.
+_ERR_MSG: dict[type[Exception], str] = {
+    BadRequest: "File too large or inaccessible.",
+    TimedOut: "Telegram timeout, please retry.",
+}
+_ERR_TYPES = tuple(_ERR_MSG)
+
+# --- File Path Cache ---
+# The file_path returned by get_file stays valid for at least an hour, so repeated forwards of the
+# same file can reuse it instead of making another round-trip to the Bot API.
+FILE_PATH_TTL = 3600
+FILE_PATH_CACHE_MAXSIZE = 4096
+_FILE_PATH_CACHE: dict[str, tuple[float, str]] = {}
+# get_file calls currently in flight, so concurrent requests for the same file_id share one call.
+# A future resolves to None if the task making the call was cancelled, telling waiters to retry.
+_INFLIGHT: dict[str, asyncio.Future[tuple[float, str] | None]] = {}
+
+def _get_cached_file_path(file_id: str) -> tuple[float, str] | None:
+    """Returns (fetched_at, file_path) for file_id, or None if missing or expired."""
+    cached = _FILE_PATH_CACHE.get(file_id)
+    if cached and time.monotonic() - cached[0] < FILE_PATH_TTL:
+        return cached
+    return None
+
+async def _resolve_file_path(bot, file_id: str) -> tuple[float, str]:
+    """Returns (fetched_at, file_path) for file_id, calling get_file only on a cache miss.
 
-if not BOT_TOKEN or not VERCEL_BASE_URL:
-    logger.error("BOT_TOKEN and VERCEL_BASE_URL environment variables must be set.")
-    # The bot will still run, but the handlers will check for these variables before processing a file.
+    fetched_at is the time.monotonic() at which get_file was called, so callers can tell when the
+    file_path expires.
+    """
+    cached = _get_cached_file_path(file_id)
+    if cached:
+        return cached
+
+    while inflight := _INFLIGHT.get(file_id):
+        # Shielded so a cancelled waiter does not cancel the result for everyone else
+        result = await asyncio.shield(inflight)
+        if result:
+            return result
+        # The task making the call was cancelled; join the next call or make it ourselves
+
+    fut = asyncio.get_running_loop().create_future()
+    _INFLIGHT[file_id] = fut
+    try:
+        now = time.monotonic()
+        file_obj = await bot.get_file(file_id)
+        file_path = _relative_file_path(file_obj.file_path)
+        if len(_FILE_PATH_CACHE) >= FILE_PATH_CACHE_MAXSIZE:
+            # Dicts keep insertion order, so the first key is the oldest entry
+            del _FILE_PATH_CACHE[next(iter(_FILE_PATH_CACHE))]
+        _FILE_PATH_CACHE[file_id] = (now, file_path)
+        fut.set_result((now, file_path))
+        return now, file_path
+    except asyncio.CancelledError:
+        # Only this task was cancelled; the waiters retry instead of being cancelled with it
+        fut.set_result(None)
+        raise
+    except Exception as e:
+        fut.set_exception(e)
+        # Mark the exception as retrieved, so there is no warning if nobody else was waiting
+        fut.exception()
+        raise
+    finally:
+        del _INFLIGHT[file_id]
+
+# --- Response Cache ---
+# The reply text is fully determined by (file_id, file_name), so a repeated forward can skip
+# get_file and all URL building. Entries are stamped with the time their file_path was fetched,
+# not when the reply was built, so they expire together with the file_path the links embed.
+RESPONSE_CACHE_MAXSIZE = 4096
+_RESPONSE_CACHE: OrderedDict[tuple[str, str], tuple[float, str]] = OrderedDict()
+
+def _get_cached_response(key: tuple[str, str]) -> str | None:
+    """Returns the cached reply text for key, or None if missing or expired."""
+    cached = _RESPONSE_CACHE.get(key)
+    if cached and time.monotonic() - cached[0] < FILE_PATH_TTL:
+        return cached[1]
+    return None
+
+def _cache_response(key: tuple[str, str], response_text: str, fetched_at: float) -> None:
+    """Stores the reply text for key, built from a file_path fetched at fetched_at.
+
+    Evicts the oldest entry when full.
+    """
+    _RESPONSE_CACHE[key] = (fetched_at, response_text)
+    _RESPONSE_CACHE.move_to_end(key)
+    if len(_RESPONSE_CACHE) > RESPONSE_CACHE_MAXSIZE:
+        _RESPONSE_CACHE.popitem(last=False)
+
+# --- Webhook Replies ---
+# While the webhook endpoint processes an update, this holds a list the handlers can put one Bot API
+# call into instead of making it themselves. The endpoint returns that call as the webhook's HTTP
+# response body, which Telegram executes, saving an outbound round-trip. None outside the webhook.
+_WEBHOOK_REPLIES: contextvars.ContextVar[list[dict] | None] = contextvars.ContextVar(
+    "_WEBHOOK_REPLIES", default=None
+)
 
 # --- Telegram Handlers ---
 
+# Message filters for the file handlers, composed once at import and shared by every Application.
+# The media filters also match edited messages and channel posts, where update.message is None,
+# so each is restricted to new messages. filters.COMMAND only looks at text entities and can never
+# match a media message, so "& ~filters.COMMAND" is left out.
+_VIDEO_FILTER = filters.UpdateType.MESSAGE & filters.VIDEO
+_AUDIO_FILTER = filters.UpdateType.MESSAGE & filters.AUDIO
+_DOCUMENT_FILTER = filters.UpdateType.MESSAGE & filters.Document.ALL
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Sends a welcome message when the /start command is issued."""
     await update.message.reply_text(
@@ -35,99 +249,230 @@ async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "Just send me a file (video, audio, document) and I will generate the direct links for you."
     )
 
-async def handle_file(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    """Handles incoming files and generates Vercel streaming/download links."""
+async def _handle_video(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles incoming videos."""
     message = update.message
-    file_info = None
-    file_name = None
-
-    # Check for different file types
-    if message.video:
-        file_info = message.video
-        file_name = file_info.file_name or f"video_{file_info.file_unique_id}.mp4"
-    elif message.audio:
-        file_info = message.audio
-        file_name = file_info.file_name or f"audio_{file_info.file_unique_id}.mp3"
-    elif message.document:
-        file_info = message.document
-        file_name = file_info.file_name or f"document_{file_info.file_unique_id}"
-    
-    if not file_info:
-        # This case should ideally be caught by the filter, but as a fallback:
-        await message.reply_text("Please send a file (video, audio, or document).")
-        return
+    file_info = message.video
+    file_name = file_info.file_name or f"video_{file_info.file_unique_id}.mp4"
+    await _reply_with_links(message, file_info, file_name, context)
 
-    if not VERCEL_BASE_URL:
-        await message.reply_text("Error: VERCEL_BASE_URL is not configured. Please set the environment variable.")
-        return
-    
-    if not BOT_TOKEN:
-        await message.reply_text("Error: BOT_TOKEN is not configured. Please set the environment variable.")
+async def _handle_audio(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles incoming audio files."""
+    message = update.message
+    file_info = message.audio
+    file_name = file_info.file_name or f"audio_{file_info.file_unique_id}.mp3"
+    await _reply_with_links(message, file_info, file_name, context)
+
+async def _handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Handles incoming documents."""
+    message = update.message
+    file_info = message.document
+    file_name = file_info.file_name or f"document_{file_info.file_unique_id}"
+    await _reply_with_links(message, file_info, file_name, context)
+
+async def _send_or_edit(message, ack_task, text: str, **kwargs):
+    """Edits the placeholder sent by ack_task with text, or replies with text if there is none.
+
+    Inside the webhook, the reply is handed back as the webhook response instead of being sent.
+    """
+    if ack_task is not None:
+        ack = (await asyncio.gather(ack_task, return_exceptions=True))[0]
+        if isinstance(ack, Message):
+            return await ack.edit_text(text, **kwargs)
+
+    webhook_replies = _WEBHOOK_REPLIES.get()
+    if webhook_replies is not None and not webhook_replies:
+        reply = {"method": "sendMessage", "chat_id": message.chat_id, "text": text}
+        for key, value in kwargs.items():
+            reply[key] = value.to_dict() if isinstance(value, TelegramObject) else value
+        # Match what reply_text fills in by default: stay in the forum topic the file was sent to,
+        # and quote the file's message outside private chats
+        if message.is_topic_message:
+            reply["message_thread_id"] = message.message_thread_id
+        if message.chat.type != ChatType.PRIVATE:
+            reply["reply_parameters"] = {"message_id": message.message_id}
+        webhook_replies.append(reply)
+        return None
+    return await message.reply_text(text, **kwargs)
+
+async def _reply_with_links(message, file_info, file_name: str, context: ContextTypes.DEFAULT_TYPE):
+    """Generates Vercel streaming/download links for file_info and replies with them."""
+    # BOT_TOKEN and VERCEL_BASE_URL are checked once at startup, so they are not re-checked here
+    cache_key = (file_info.file_id, file_name)
+    cached_text = _get_cached_response(cache_key)
+    if cached_text:
+        await _send_or_edit(message, None, cached_text, parse_mode=ParseMode.HTML, link_preview_options=_NO_LINK_PREVIEW)
         return
 
+    cached_path = None
+    ack_task = None
+    if not VERCEL_RESOLVES_FILE_ID:
+        cached_path = _get_cached_file_path(file_info.file_id)
+        if not cached_path and _WEBHOOK_REPLIES.get() is None:
+            # Send a placeholder while get_file is in flight, then edit it with the links,
+            # so the two round-trips to Telegram overlap instead of running back to back.
+            # Not needed inside the webhook, where the links go back in the response body.
+            ack_task = asyncio.create_task(message.reply_text("⌛ Generating link…"))
+
     try:
-        # 1. Get the File object from Telegram to obtain the file_path
-        # This step requires the BOT_TOKEN and is the critical part that allows the Vercel app to fetch the file.
-        file_obj = await context.bot.get_file(file_info.file_id)
-        
-        # The file_path is used to construct the direct Telegram file URL
-        file_path = file_obj.file_path
-        
-        # 2. Construct the full, direct Telegram file URL
-        # Format: https://api.telegram.org/file/bot<token>/<file_path>
-        telegram_file_url = f"https://api.telegram.org/file/bot{BOT_TOKEN}/{file_path}"
-        
-        # 3. URL-encode the Telegram file URL for the Vercel app's query parameter
-        # We use quote_plus to encode spaces as '+' which is standard for query parameters
-        encoded_telegram_url = urllib.parse.quote_plus(telegram_file_url)
+        if VERCEL_RESOLVES_FILE_ID:
+            # 1-3. The Vercel app resolves the file_id with get_file on its side,
+            # so the bot skips that round-trip and only passes the file_id along.
+            # file_id links don't expire, so the reply is only bounded by the cache TTL
+            fetched_at = time.monotonic()
+            query_prefix, query_value = _FILE_ID_QUERY, file_info.file_id
+        else:
+            # 1. Get the file_path from Telegram (cached per file_id)
+            # This step requires the BOT_TOKEN and is the critical part that allows the Vercel app to fetch the file.
+            # The file_path is used to construct the direct Telegram file URL
+            try:
+                fetched_at, file_path = cached_path or await _resolve_file_path(context.bot, file_info.file_id)
+            except _ERR_TYPES as e:
+                # Expected get_file failures (file too big, bad file_id, timeout) get a canned reply
+                logger.warning("Error processing file: %s", e)
+                error_text = next(text for err_type, text in _ERR_MSG.items() if isinstance(e, err_type))
+                await _send_or_edit(message, ack_task, error_text)
+                return
+
+            # 2-3. The direct Telegram file URL goes in the Vercel app's query parameter, URL-encoded with
+            # quote_plus (spaces as '+', standard for query parameters). The prefix is pre-encoded,
+            # so only the file_path needs encoding.
+            query_prefix, query_value = _FILE_URL_QUERY, file_path
 
         # 4. Construct the final Vercel streaming and download links
-        
-        # Sanitize filename for URL path (standard quote)
-        safe_filename = urllib.parse.quote(file_name)
-        
+        # The filename is sanitized for the URL path (standard quote).
         # Vercel endpoints (based on vercel.json rewrite rules):
-        # /watch/{filename}?file_url={encoded_telegram_url}
-        # /download/{filename}?file_url={encoded_telegram_url}
-        
-        streaming_link = f"{VERCEL_BASE_URL}/watch/{safe_filename}?file_url={encoded_telegram_url}"
-        download_link = f"{VERCEL_BASE_URL}/download/{safe_filename}?file_url={encoded_telegram_url}"
+        # /watch/{filename}?file_url={encoded_telegram_url}   (or ?file_id={file_id})
+        # /download/{filename}?file_url={encoded_telegram_url}   (or ?file_id={file_id})
+        streaming_link, download_link = build_urls(VERCEL_BASE_URL, file_name, query_prefix, query_value)
         
-        response_text = (
-            f"**File:** `{file_name}`\n\n"
-            f"**Streaming Link:**\n`{streaming_link}`\n\n"
-            f"**Download Link:**\n`{download_link}`\n\n"
-            "The Vercel application will stream the file directly from Telegram's servers."
+        # The links are percent-encoded, so only the file name can contain HTML special characters
+        response_text = "".join(
+            (_RESP_FILE, html.escape(file_name), _RESP_STREAM, streaming_link, _RESP_DOWNLOAD, download_link, _RESP_TAIL)
         )
+        _cache_response(cache_key, response_text, fetched_at)
         
-        await message.reply_text(response_text, parse_mode='Markdown', disable_web_page_preview=True)
+        await _send_or_edit(message, ack_task, response_text, parse_mode=ParseMode.HTML, link_preview_options=_NO_LINK_PREVIEW)
 
     except Exception as e:
-        logger.error(f"Error processing file: {e}")
-        await message.reply_text(f"An error occurred while generating the links: {e}")
+        logger.exception("Error processing file")
+        await _send_or_edit(message, ack_task, f"An error occurred while generating the links: {e}")
 
 
-def main():
-    """Start the bot."""
-    if not BOT_TOKEN:
-        logger.error("Cannot start bot: BOT_TOKEN is not configured.")
-        return
+def build_application() -> Application:
+    """Creates the Application with its handlers."""
+    # quote_plus encodes character by character, so encoding the prefix separately must match
+    # encoding the whole URL in one go. The table-driven encoders must also match urllib's.
+    # sample_url is shaped like the file_path get_file returns: the full download URL.
+    sample_url = f"{TG_FILE_PREFIX}documents/file 1.mp4"
+    sample_name = "Ünïcode name (1) & more~.mkv"
+    sample_suffix = f"{urllib.parse.quote(sample_name)}?file_url={urllib.parse.quote_plus(sample_url)}"
+    assert build_urls("", sample_name, _FILE_URL_QUERY, _relative_file_path(sample_url)) == (
+        f"/watch/{sample_suffix}",
+        f"/download/{sample_suffix}",
+    )
 
     # Create the Application and pass it your bot's token.
-    application = Application.builder().token(BOT_TOKEN).build()
+    # All Bot API calls (get_file, reply_text) share one HTTP/2 connection pool, so handlers reuse a
+    # warm TLS session to the Bot API server instead of handshaking on a cold connection.
+    # getUpdates gets its own small pool, since its long poll holds a connection open.
+    request = HTTPXRequest(connection_pool_size=32, http_version="2", read_timeout=20, connect_timeout=5)
+    get_updates_request = HTTPXRequest(connection_pool_size=1, read_timeout=20, connect_timeout=5)
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .base_url(TG_API_BASE)
+        .base_file_url(TG_FILE_BASE)
+        .request(request)
+        .get_updates_request(get_updates_request)
+        .build()
+    )
 
     # Handlers
     application.add_handler(CommandHandler("start", start))
     application.add_handler(CommandHandler("help", help_command))
 
-    # Message handler for files (video, audio, document) but excluding commands
-    file_filter = filters.ATTACHMENT | filters.VIDEO | filters.AUDIO | filters.DOCUMENT
-    application.add_handler(MessageHandler(file_filter & ~filters.COMMAND, handle_file))
+    # One narrow handler per file type (video, audio, document), so other updates never reach them
+    application.add_handler(MessageHandler(_VIDEO_FILTER, _handle_video))
+    application.add_handler(MessageHandler(_AUDIO_FILTER, _handle_audio))
+    application.add_handler(MessageHandler(_DOCUMENT_FILTER, _handle_document))
+
+    return application
+
+# --- Webhook App ---
+# For Render/Vercel, run the bot as an ASGI app so Telegram pushes updates to it:
+# uvicorn bot:app --host 0.0.0.0 --port $PORT --workers N
+# Each worker has its own Application and registers the same webhook on startup.
+
+async def _ensure_webhook(bot) -> None:
+    """Registers the webhook with Telegram unless it already points at this app.
+
+    All workers run this at startup. Only the first one needs to call set_webhook, and a worker that
+    loses the race to Telegram's flood control keeps running instead of failing startup.
+    Any other error (bad URL, invalid token, ...) fails startup.
+    """
+    webhook_url = f"{WEBHOOK_BASE_URL}/webhook/{BOT_TOKEN}"
+    webhook_info = await bot.get_webhook_info()
+    if webhook_info.url == webhook_url and set(webhook_info.allowed_updates) == set(Update.ALL_TYPES):
+        return
+
+    try:
+        await bot.set_webhook(webhook_url, allowed_updates=Update.ALL_TYPES)
+    except RetryAfter as e:
+        logger.warning("Could not register the webhook, assuming another worker did: %s", e)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Starts the bot and registers the webhook for the lifetime of the ASGI app."""
+    if not BOT_TOKEN or not VERCEL_BASE_URL or not WEBHOOK_BASE_URL:
+        raise RuntimeError("BOT_TOKEN, VERCEL_BASE_URL and WEBHOOK_BASE_URL must be set to run in webhook mode.")
+
+    bot_app = build_application()
+    await bot_app.initialize()
+    await bot_app.start()
+    await _ensure_webhook(bot_app.bot)
+    app.state.bot_app = bot_app
+    logger.info("Bot started in webhook mode.")
+    try:
+        yield
+    finally:
+        await bot_app.stop()
+        await bot_app.shutdown()
+
+app = FastAPI(lifespan=lifespan)
+
+@app.post("/webhook/{token}")
+async def webhook(token: str, request: Request):
+    """Receives an update from Telegram and runs it through the bot's handlers."""
+    # The token in the path keeps anyone who doesn't know it from injecting fake updates
+    if token != BOT_TOKEN:
+        return Response(status_code=404)
+
+    bot_app = request.app.state.bot_app
+    update = Update.de_json(await request.json(), bot_app.bot)
+    webhook_replies = []
+    reset_token = _WEBHOOK_REPLIES.set(webhook_replies)
+    try:
+        await bot_app.process_update(update)
+    finally:
+        _WEBHOOK_REPLIES.reset(reset_token)
+
+    # Telegram executes a Bot API call returned as the response body, so the reply costs no extra request
+    if webhook_replies:
+        return JSONResponse(webhook_replies[0])
+    return Response(status_code=200)
+
+
+def main():
+    """Start the bot in polling mode (for local development)."""
+    if not BOT_TOKEN or not VERCEL_BASE_URL:
+        logger.error("Cannot start bot: BOT_TOKEN and VERCEL_BASE_URL environment variables must be set.")
+        return
+
+    application = build_application()
 
     # Run the bot
-    # For Render, you typically use a web service that runs a command like:
-    # python bot.py
-    # This will start the polling loop.
+    # Deployments use the webhook app above; running python bot.py starts the polling loop.
     logger.info("Starting bot in polling mode...")
     application.run_polling(allowed_updates=Update.ALL_TYPES)
 